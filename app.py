@@ -1,18 +1,37 @@
 from flask import Flask, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
-
-from pdf2image import convert_from_bytes
-from PIL import Image
-
+from werkzeug.exceptions import RequestEntityTooLarge
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # libvips is optional, fall back to pdftoppm when it is missing
+    pyvips = None
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import io
+import logging
 import os
-import tempfile
-import shutil
+import subprocess
+import threading
 
+from reportlab import rl_config
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 
+# Skip reportlab's per-attribute shape checks and emit reproducible output
+rl_config.shapeChecking = 0
+rl_config.invariant = 1
+# Embed JPEG data as-is instead of ASCII85-encoding it
+rl_config.useA85 = 0
+
 app = Flask(__name__, static_folder='static', static_url_path='')
 
+log = logging.getLogger(__name__)
+
 CORS(app)
 
 # Configuration
@@ -21,7 +40,19 @@ PDF_WIDTH = 612
 PDF_HEIGHT = 792
 GRID_COLS = 5
 GRID_ROWS = 2
-DPI = 300
+# Rasterization resolution: 150 DPI already exceeds what a grid cell can
+# show, use the `dpi` query argument for print quality
+DPI = 150
+MIN_DPI = 72
+MAX_DPI = 600
+# Longest a single pdftoppm run may take before the PDF is rejected
+RENDER_TIMEOUT = 30
+# Crops are handed to reportlab as JPEG, which it embeds without
+# re-encoding (it still decodes each one once to name the image)
+JPEG_QUALITY = 85
+
+# Maximum accepted request body size
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
 
 # Page margins (matching original PDF layout)
 LEFT_MARGIN = 55
@@ -29,6 +60,35 @@ RIGHT_MARGIN = 55
 TOP_MARGIN = 52
 BOTTOM_MARGIN = 52
 
+# Usable area for the grid inside page margins
+AVAILABLE_WIDTH = PDF_WIDTH - (LEFT_MARGIN + RIGHT_MARGIN)
+AVAILABLE_HEIGHT = PDF_HEIGHT - (TOP_MARGIN + BOTTOM_MARGIN)
+CELL_WIDTH = AVAILABLE_WIDTH / GRID_COLS
+CELL_HEIGHT = AVAILABLE_HEIGHT / GRID_ROWS
+
+# Bottom-left corner of each grid cell, filled row by row from the top
+CELLS = tuple(
+    (
+        LEFT_MARGIN + (idx % GRID_COLS) * CELL_WIDTH,
+        PDF_HEIGHT - TOP_MARGIN - (idx // GRID_COLS + 1) * CELL_HEIGHT,
+    )
+    for idx in range(GRID_COLS * GRID_ROWS)
+)
+
+# Rendered crops kept in memory, keyed by PDF content hash and DPI.
+# Bounded by total JPEG bytes, since crop size grows with the requested DPI
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_render_cache = OrderedDict()
+_render_cache_bytes = 0
+_render_cache_lock = threading.Lock()
+
+# One render pool per process, shared by all request threads, so the number
+# of concurrent rasterizers never exceeds the core count
+_render_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# Enforced by werkzeug while parsing the body, chunked uploads included
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+
 
 @app.route('/')
 def index():
@@ -49,138 +109,268 @@ def process_pdfs():
             if file.filename == '' or not file.filename.lower().endswith('.pdf'):
                 return jsonify({'error': f'Invalid file: {file.filename}'}), 400
 
-        # Crop illustrations from each PDF
-        images = []
+        # Accept plain digits only: int() would also take '1_50' or ' 72 '
+        dpi = request.args.get('dpi', str(DPI))
+        dpi = int(dpi) if dpi.isascii() and dpi.isdigit() else None
+        if dpi is None or not MIN_DPI <= dpi <= MAX_DPI:
+            return jsonify({'error': f'DPI must be between {MIN_DPI} and {MAX_DPI}'}), 400
+
+        pdf_bytes_list = []
         for file in files:
-            pdf_bytes = file.read()
-            try:
-                # Convert first page of PDF to image
-                images_list = convert_from_bytes(
-                    pdf_bytes,
-                    dpi=DPI,
-                    first_page=1,
-                    last_page=1
-                )
-
-                if images_list:
-                    img = images_list[0]
-
-                    # Compute scaling factor (PDF points -> pixels)
-                    # Standard PDF is 72 DPI, convert to configured DPI
-                    scale = DPI / 72.0
-
-                    # Crop the specified area (in PDF points)
-                    x0, y0, x1, y1 = CROP_BOX
-
-                    # Convert coordinates from points to pixels
-                    px0 = int(x0 * scale)
-                    py0 = int(y0 * scale)
-                    px1 = int(x1 * scale)
-                    py1 = int(y1 * scale)
-
-                    # Crop image
-                    cropped = img.crop((px0, py0, px1, py1))
-                    images.append(cropped)
-                    print(f"✓ Cropped image {len(images)}: {cropped.size}")
-            except Exception as e:
-                print(f"❌ PDF error: {str(e)}")
-                return jsonify({'error': f'Error processing PDF: {str(e)}'}), 400
-
-        print(f"✓ Total cropped images: {len(images)}")
-
-        # Create output PDF with grid
-        output_pdf = create_grid_pdf(images)
+            pdf_bytes_list.append(file.read())
+            # Release the spooled upload as soon as its bytes are read
+            file.close()
+
+        # Create output PDF with grid, placing each crop as soon as it is ready
+        try:
+            output_pdf = create_grid_pdf(_iter_crops(pdf_bytes_list, dpi), dpi)
+        except PdfProcessingError as e:
+            log.warning("❌ PDF error: %s", e)
+            return jsonify({'error': f'Error processing PDF: {str(e)}'}), 400
 
         return send_file(
             output_pdf,
             mimetype='application/pdf',
             as_attachment=True,
-            download_name='output.pdf'
+            download_name='output.pdf',
+            max_age=0
         )
 
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'Upload exceeds {MAX_UPLOAD_SIZE // (1024 * 1024)} MB'}), 413
+
     except Exception as e:
-        print(f"❌ General error: {str(e)}")
+        log.exception("❌ General error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
-def create_grid_pdf(images):
+class PdfProcessingError(Exception):
     """
-    Create a PDF with the cropped images arranged
-    in a 5x2 grid, with page margins matching the original layout.
+    Raised when an uploaded PDF cannot be rasterized.
     """
-    grid_cols = GRID_COLS
-    grid_rows = GRID_ROWS
 
-    # Usable area for the grid inside page margins
-    available_width = PDF_WIDTH - (LEFT_MARGIN + RIGHT_MARGIN)
-    available_height = PDF_HEIGHT - (TOP_MARGIN + BOTTOM_MARGIN)
 
-    cell_width = available_width / grid_cols
-    cell_height = available_height / grid_rows
+def _iter_crops(pdf_bytes_list, dpi):
+    """
+    Yield (idx, ImageReader) pairs in upload order. Crops of PDFs rendered
+    by earlier requests come from the cache; the rest are rendered in
+    parallel and handed out one at a time, so only the crop being drawn
+    has to be decoded by reportlab.
+    """
+    # blake2b is faster than SHA-256 and plenty to tell uploads apart
+    keys = [
+        (hashlib.blake2b(pdf_bytes, digest_size=16).digest(), dpi)
+        for pdf_bytes in pdf_bytes_list
+    ]
+    results = [_cache_get(key) for key in keys]
+
+    # Render each distinct uncached PDF once, however many times it was uploaded
+    missing = {}
+    for idx, key in enumerate(keys):
+        if results[idx] is None and key not in missing:
+            missing[key] = idx
+    missing = list(missing.values())
+
+    # Rendering runs in pdftoppm/libvips outside the GIL, so threads are enough
+    pending = {
+        keys[idx]: _render_executor.submit(_render_and_crop, pdf_bytes_list[idx], dpi)
+        for idx in missing
+    }
+    try:
+        rendered = {}
+        for idx, key in enumerate(keys):
+            jpeg = results[idx] or rendered.get(key)
+            results[idx] = None
+            if jpeg is None:
+                try:
+                    jpeg = pending.pop(key).result()
+                except PdfProcessingError:
+                    raise
+                except Exception as e:
+                    raise PdfProcessingError(str(e)) from e
+                _cache_put(key, jpeg)
+                rendered[key] = jpeg
+
+            cropped = ImageReader(io.BytesIO(jpeg))
+            log.debug("✓ Cropped image %d: %s", idx + 1, cropped.getSize())
+            yield idx, cropped
+    finally:
+        # On failure, drop this request's renders that have not started yet
+        for future in pending.values():
+            future.cancel()
 
-    print(f"Grid: {cell_width} x {cell_height} points per cell")
 
-    output = io.BytesIO()
-    c = canvas.Canvas(output, pagesize=(PDF_WIDTH, PDF_HEIGHT))
+def _cache_get(key):
+    """
+    Return the cached render result for `key`, or None on a miss.
+    """
+    with _render_cache_lock:
+        result = _render_cache.get(key)
+        if result is not None:
+            _render_cache.move_to_end(key)
+        return result
 
-    # Force metadata values (must not be None)
-    c.setTitle("")        # or a real title
-    c.setAuthor("")       # empty string avoids '(anonymous)'
-    c.setSubject("")      # empty string avoids '(unspecified)'
-    c.setCreator("")      # empty string avoids '(unspecified)'
-    c.setKeywords("")
 
-    temp_dir = tempfile.mkdtemp()
+def _cache_put(key, result):
+    """
+    Store a render result, evicting the least recently used entries
+    until the cache fits in RENDER_CACHE_MAX_BYTES.
+    """
+    global _render_cache_bytes
+
+    if len(result) > RENDER_CACHE_MAX_BYTES:
+        return
+
+    with _render_cache_lock:
+        previous = _render_cache.pop(key, None)
+        if previous is not None:
+            _render_cache_bytes -= len(previous)
+        _render_cache[key] = result
+        _render_cache_bytes += len(result)
+        while _render_cache_bytes > RENDER_CACHE_MAX_BYTES:
+            _, evicted = _render_cache.popitem(last=False)
+            _render_cache_bytes -= len(evicted)
 
+
+@functools.lru_cache(maxsize=32)
+def _crop_pixels(dpi):
+    """
+    Return CROP_BOX converted to pixel coordinates at `dpi`,
+    computed once per resolution.
+    """
+    # Compute scaling factor (PDF points -> pixels)
+    # Standard PDF is 72 DPI, convert to requested DPI
+    scale = dpi / 72.0
+
+    # Crop the specified area (in PDF points)
+    x0, y0, x1, y1 = CROP_BOX
+
+    # Convert coordinates from points to pixels
+    px0 = int(x0 * scale)
+    py0 = int(y0 * scale)
+    px1 = int(x1 * scale)
+    py1 = int(y1 * scale)
+
+    return px0, py0, px1, py1
+
+
+def _render_and_crop(pdf_bytes, dpi):
+    """
+    Rasterize only the illustration area of the first PDF page, with
+    libvips when available and pdftoppm otherwise.
+    Returns the crop as JPEG bytes, which reportlab embeds without re-encoding.
+    """
+    px0, py0, px1, py1 = _crop_pixels(dpi)
+
+    if pyvips is not None:
+        # libvips renders lazily, so only the tiles of the crop are drawn
+        page = pyvips.Image.pdfload_buffer(pdf_bytes, dpi=dpi, page=0)
+        cropped = page.crop(px0, py0, px1 - px0, py1 - py0)
+        cropped = cropped.flatten(background=255).cast('uchar')
+        return cropped.write_to_buffer(f'.jpg[Q={JPEG_QUALITY}]')
+
+    # Let poppler render just the crop area of the first page,
+    # reading the PDF from stdin and writing a JPEG to stdout
     try:
-        for idx, img in enumerate(images):
-            if idx >= (grid_rows * grid_cols):
-                break
+        proc = subprocess.run(
+            [
+                'pdftoppm',
+                '-f', '1', '-l', '1',
+                '-r', str(dpi),
+                '-x', str(px0), '-y', str(py0),
+                '-W', str(px1 - px0), '-H', str(py1 - py0),
+                '-jpeg', '-jpegopt', f'quality={JPEG_QUALITY}',
+                '-singlefile',
+                '-',
+            ],
+            input=pdf_bytes,
+            capture_output=True,
+            timeout=RENDER_TIMEOUT
+        )
+    except subprocess.TimeoutExpired as e:
+        # subprocess.run has already killed pdftoppm at this point
+        raise PdfProcessingError(f'Rendering timed out after {RENDER_TIMEOUT} s') from e
+    if proc.returncode != 0 or not proc.stdout:
+        raise RuntimeError(proc.stderr.decode(errors='replace').strip() or 'pdftoppm failed')
 
-            row = idx // grid_cols
-            col = idx % grid_cols
+    return proc.stdout
 
-            # Cell coordinates (starting from top of page)
-            x_cell = LEFT_MARGIN + col * cell_width
-            y_cell = PDF_HEIGHT - TOP_MARGIN - (row + 1) * cell_height
 
-            print(f"Image {idx}: row={row}, col={col}, cell=({x_cell}, {y_cell})")
+@functools.lru_cache(maxsize=32)
+def _grid_placements(img_width, img_height, dpi):
+    """
+    Return (x, y, width, height) in points for an image of the given
+    pixel size centered in every grid cell.
+    """
+    # Original image size in pixels -> display size in points
+    img_display_width = img_width * 72.0 / dpi
+    img_display_height = img_height * 72.0 / dpi
 
-            # Original image size in pixels
-            img_width, img_height = img.size
-            img_display_width = img_width * 72.0 / DPI
-            img_display_height = img_height * 72.0 / DPI
+    # Center image inside each cell
+    offset_x = (CELL_WIDTH - img_display_width) / 2
+    offset_y = (CELL_HEIGHT - img_display_height) / 2
 
-            # Center image inside the cell
-            img_x = x_cell + (cell_width - img_display_width) / 2
-            img_y = y_cell + (cell_height - img_display_height) / 2
+    return tuple(
+        (x_cell + offset_x, y_cell + offset_y, img_display_width, img_display_height)
+        for x_cell, y_cell in CELLS
+    )
 
-            print(f" Display size: {img_display_width} x {img_display_height}")
-            print(f" Position: ({img_x}, {img_y})")
 
-            # Save image temporarily to disk
-            temp_img_path = os.path.join(temp_dir, f'img_{idx}.png')
-            img.save(temp_img_path, format='PNG')
+def create_grid_pdf(images, dpi=DPI):
+    """
+    Create a PDF with the cropped images arranged
+    in a 5x2 grid, with page margins matching the original layout.
+    `images` is an iterable of (idx, ImageReader) pairs, drawn as they
+    arrive, and `dpi` is the resolution they were rasterized at.
+    """
+    log.debug("Grid: %s x %s points per cell", CELL_WIDTH, CELL_HEIGHT)
 
-            # Draw image on the canvas
-            c.drawImage(
-                temp_img_path,
-                img_x,
-                img_y,
-                width=img_display_width,
-                height=img_display_height
-            )
+    output = io.BytesIO()
 
-        c.save()
-        output.seek(0)
-        print("✓ Output PDF saved successfully")
+    # Page content is a handful of image operators and the JPEG
+    # data is already compressed, so skip the extra zlib pass
+    c = canvas.Canvas(output, pagesize=(PDF_WIDTH, PDF_HEIGHT), pageCompression=0)
 
-    finally:
-        # Clean up temporary files
-        shutil.rmtree(temp_dir, ignore_errors=True)
+    # Force metadata values (must not be None)
+    c.setTitle("")        # or a real title
+    c.setAuthor("")       # empty string avoids '(anonymous)'
+    c.setSubject("")      # empty string avoids '(unspecified)'
+    c.setCreator("")      # empty string avoids '(unspecified)'
+    c.setKeywords("")
+
+    count = 0
+    for idx, img in images:
+        if idx >= len(CELLS):
+            break
+
+        # Crops share one size, so the whole layout is computed once
+        img_width, img_height = img.getSize()
+        placements = _grid_placements(img_width, img_height, dpi)
+        img_x, img_y, img_display_width, img_display_height = placements[idx]
+
+        log.debug("Image %d: cell=%s", idx, CELLS[idx])
+        log.debug(" Display size: %s x %s", img_display_width, img_display_height)
+        log.debug(" Position: (%s, %s)", img_x, img_y)
+
+        # Draw image on the canvas straight from memory
+        c.drawImage(
+            img,
+            img_x,
+            img_y,
+            width=img_display_width,
+            height=img_display_height
+        )
+        count += 1
+
+    log.debug("✓ Total cropped images: %d", count)
+
+    c.save()
+    output.seek(0)
+    log.debug("✓ Output PDF saved successfully")
 
     return output
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
     app.run(debug=True, port=5000)
@@ -125,24 +125,12 @@ def create_grid_pdf_from_pages(pages):
         print(f"  crop size={crop_w}x{crop_h}")
         print(f"  posizionato a ({tx},{ty})")
 
-        # Crea una pagina temporanea e ritagliala correttamente
-        tmp_writer = PdfWriter()
-        tmp_writer.add_page(src_page)
-        tmp_buf = io.BytesIO()
-        tmp_writer.write(tmp_buf)
-        tmp_buf.seek(0)
-        tmp_reader = PdfReader(tmp_buf)
-        tmp_page = tmp_reader.pages[0]
-
-        # Reset mediabox a cropbox per visualizzare solo il ritaglio
-        tmp_page.mediabox = tmp_page.cropbox
-
         # Trasforma: trasla per posizionare nella cella
         t = Transformation().translate(tx=tx - cx0, ty=ty - cy0)
-        tmp_page.add_transformation(t)
-        
-        # Merge sulla pagina base
-        base_page.merge_page(tmp_page)
+
+        # Merge diretto sulla pagina base: pypdf applica la trasformazione
+        # in un colpo solo, senza riscrivere e rileggere la pagina sorgente
+        base_page.merge_transformed_page(src_page, t)
 
     # Scrivi su BytesIO
     output = io.BytesIO()